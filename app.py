@@ -3,25 +3,97 @@ import os
 import re
 import sqlite3
 import hashlib
+import hmac
 import json
 import random
+import queue
 import calendar
 from datetime import date, datetime
-from flask import Flask, request, jsonify, render_template, g, session
+from functools import wraps
+from flask import Flask, Response, request, jsonify, render_template, g, session, has_app_context
 
 DB = "routelink.db"
 HOL_JSON = "academic_holidays.json"
 HOL_CSV = "academic_holidays.csv"
 
+_VIT_EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+-]+@vitstudent\.ac\.in$")
+
+# message list paging (GET /conversations/<id>/messages?after_id=&limit=)
+MESSAGES_PAGE_DEFAULT = 100
+MESSAGES_PAGE_MAX = 500
+
+# hot-path statements, kept in one place (get_db also raises cached_statements so they stay prepared)
+SQL_CALENDAR_FOR_DATE = """
+    SELECT DISTINCT r.id, r.slot_no, r.end_point, r.major_stops, r.time, r.transport_type
+    FROM calendar cal LEFT JOIN routes r ON cal.route_id = r.id
+    WHERE cal.travel_date = ? ORDER BY r.id DESC
+"""
+SQL_ROUTE_COUNT = "SELECT COUNT(*) FROM calendar WHERE travel_date=? AND route_id=? AND link_id IS NOT NULL"
+SQL_ROUTE_LINKS = """
+    SELECT l.id, l.user_id, l.name, l.gender, l.drop_point, l.phone, l.course_year, l.branch
+    FROM links l JOIN calendar cal ON cal.link_id = l.id
+    WHERE cal.route_id = ? AND cal.travel_date = ?
+    ORDER BY l.id DESC
+"""
+SQL_IS_MEMBER = "SELECT 1 FROM conversation_members WHERE conversation_id=? AND user_id=? LIMIT 1"
+SQL_MESSAGES = """
+    SELECT m.id, m.sender_id, m.sender_name, m.text, m.ts
+    FROM conversation_members mem
+    LEFT JOIN messages m ON m.conversation_id = mem.conversation_id AND m.id > ?
+    WHERE mem.conversation_id=? AND mem.user_id=?
+    ORDER BY m.id ASC LIMIT ?
+"""
+SQL_INSERT_MESSAGE = "INSERT INTO messages (conversation_id, sender_id, sender_name, text) VALUES (?,?,?,?)"
+
 app = Flask(__name__, template_folder="templates", static_folder="static")
 app.secret_key = os.environ.get("ROUTELINK_SECRET", "dev-secret-change-me")  # change in production
 app.config['JSON_SORT_KEYS'] = False
 
+# optional Redis response cache for read-mostly endpoints (disabled unless ROUTELINK_REDIS_URL is set)
+try:
+    import redis
+except ImportError:
+    redis = None
+REDIS_URL = os.environ.get("ROUTELINK_REDIS_URL")
+# the Tkinter client writes routelink.db directly and skips invalidation, so its changes can be up to CACHE_TTL seconds stale
+CACHE_TTL = 60
+_r = redis.Redis.from_url(REDIS_URL, decode_responses=True, socket_timeout=0.5) if (redis and REDIS_URL) else None
+
+# orjson is optional; it encodes the larger list responses several times faster than stdlib json
+try:
+    import orjson
+    def dumps_json(o) -> bytes:
+        return orjson.dumps(o)
+except ImportError:
+    def dumps_json(o) -> bytes:
+        return json.dumps(o).encode()
+
+def json_response(o, status: int = 200):
+    return app.response_class(dumps_json(o), status=status, mimetype="application/json")
+
 # ---------------- DB helpers ----------------
-def ensure_column(table: str, column: str, col_type: str, default: str = None):
+# per-connection settings: 256MB mmap, 64MB page cache, temp tables in memory
+CONN_PRAGMAS = (
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+
+def tune_connection(conn):
+    for pragma in CONN_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except Exception:
+            pass
+
+def ensure_column(table: str, column: str, col_type: str, default: str = None) -> bool:
+    """Add the column if it is missing; returns True only when it was added."""
+    # reuse the request connection when there is one; only init-time calls open their own
+    added = False
+    own_conn = not has_app_context()
     conn = None
     try:
-        conn = sqlite3.connect(DB)
+        conn = sqlite3.connect(DB) if own_conn else get_db()
         c = conn.cursor()
         c.execute(f"PRAGMA table_info({table})")
         cols = [r[1] for r in c.fetchall()]
@@ -31,14 +103,16 @@ def ensure_column(table: str, column: str, col_type: str, default: str = None):
                 sql += f" DEFAULT {default}"
             c.execute(sql)
             conn.commit()
+            added = True
     except Exception:
         # best effort
         pass
     finally:
         try:
-            if conn: conn.close()
+            if conn and own_conn: conn.close()
         except Exception:
             pass
+    return added
 
 def init_db():
     """Create/upgrade database schema (idempotent)."""
@@ -50,17 +124,17 @@ def init_db():
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     name TEXT,
                     email TEXT UNIQUE,
-                    password_hash TEXT
+                    password_hash BLOB
                  )""")
 
     # routes
     c.execute("""CREATE TABLE IF NOT EXISTS routes (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     slot_no TEXT,
-                    end_point TEXT,
+                    end_point TEXT COLLATE NOCASE,
                     major_stops TEXT,
                     time TEXT,
-                    transport_type TEXT,
+                    transport_type TEXT COLLATE NOCASE,
                     no_of_people INTEGER DEFAULT 0
                  )""")
 
@@ -110,6 +184,13 @@ def init_db():
                     FOREIGN KEY(sender_id) REFERENCES users(id)
                  )""")
 
+    # indexes for the hot lookups (users.email is already covered by its UNIQUE constraint)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cal_date_route ON calendar(travel_date, route_id, link_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cal_route ON calendar(route_id, link_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cal_link ON calendar(link_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_phone ON links(phone)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_msg_conv_id ON messages(conversation_id, id DESC)")
+
     conn.commit()
     # WAL for better concurrency
     try:
@@ -118,17 +199,35 @@ def init_db():
         conn.commit()
     except Exception:
         pass
-    conn.close()
 
     # ensure optional columns exist for compatibility
     ensure_column("users", "gender", "TEXT")
     ensure_column("links", "gender", "TEXT")
     ensure_column("links", "user_id", "INTEGER", default="NULL")
+    if ensure_column("messages", "sender_name", "TEXT"):
+        # one-off backfill for messages written before the column existed
+        try:
+            c.execute("UPDATE messages SET sender_name=(SELECT name FROM users WHERE id=messages.sender_id)")
+            conn.commit()
+        except Exception:
+            pass
+    conn.close()
+
+# idle connections kept open between requests; each one is only ever used by one request at a time
+_POOL = queue.LifoQueue(maxsize=8)
+
+def _open_db():
+    conn = sqlite3.connect(DB, timeout=30, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    tune_connection(conn)
+    return conn
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DB, timeout=30, check_same_thread=False)
-        g.db.row_factory = sqlite3.Row
+        try:
+            g.db = _POOL.get_nowait()
+        except queue.Empty:
+            g.db = _open_db()
     return g.db
 
 @app.teardown_appcontext
@@ -136,12 +235,41 @@ def close_db(exc=None):
     db = g.pop('db', None)
     if db:
         try:
-            db.close()
+            # never hand a half-finished transaction to the next request
+            if db.in_transaction:
+                db.rollback()
+            _POOL.put_nowait(db)
         except Exception:
-            pass
+            try:
+                db.close()
+            except Exception:
+                pass
+
+# password hashes are stored as a BLOB: 16-byte salt + 32-byte scrypt key
+_PW_SALT_LEN = 16
 
-def hash_pw(txt: str) -> str:
-    return hashlib.sha256(txt.encode()).hexdigest()
+def _scrypt(txt: str, salt: bytes) -> bytes:
+    return hashlib.scrypt(txt.encode(), salt=salt, n=16384, r=8, p=1, dklen=32)
+
+def hash_pw(txt: str) -> bytes:
+    salt = os.urandom(_PW_SALT_LEN)
+    return salt + _scrypt(txt, salt)
+
+# checked against for unknown emails so they cost the same scrypt call as real accounts
+_DUMMY_PW_HASH = os.urandom(_PW_SALT_LEN + 32)
+
+def check_pw(txt: str, stored) -> bool:
+    if isinstance(stored, bytes) and len(stored) > _PW_SALT_LEN:
+        salt = stored[:_PW_SALT_LEN]
+        return hmac.compare_digest(_scrypt(txt, salt), stored[_PW_SALT_LEN:])
+    if isinstance(stored, str):
+        # legacy unsalted sha256 hex digest
+        return hmac.compare_digest(hashlib.sha256(txt.encode()).hexdigest(), stored)
+    return False
+
+def is_phone(s: str) -> bool:
+    # isascii() first: str.isdigit() alone also accepts non-ASCII digits such as '²' or '٣'
+    return len(s) >= 7 and s.isascii() and s.isdigit()
 
 def to_base36(n: int) -> str:
     digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -152,17 +280,23 @@ def to_base36(n: int) -> str:
         out.append(digits[rem])
     return "".join(reversed(out))
 
-def generate_next_slot_no():
+def last_route_id() -> int:
+    own_conn = not has_app_context()
     try:
-        conn = sqlite3.connect(DB)
+        conn = sqlite3.connect(DB) if own_conn else get_db()
         c = conn.cursor()
-        c.execute("SELECT MAX(id) FROM routes")
+        # AUTOINCREMENT keeps the last issued id here (no row until the first insert)
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name='routes'")
         r = c.fetchone()
-        conn.close()
-        max_id = int(r[0]) if (r and r[0]) else 0
-        seq = max_id + 1
+        if own_conn: conn.close()
+        return int(r[0]) if (r and r[0]) else 0
     except Exception:
-        seq = 1
+        return 0
+
+def generate_next_slot_no():
+    # read-only preview of the next route id from sqlite_sequence, shared by every worker and the
+    # Tkinter client; an in-process counter was tried and dropped because it drifted per process
+    seq = last_route_id() + 1
     b36 = to_base36(seq).rjust(4, "0")
     return f"SL{b36}"
 
@@ -196,9 +330,22 @@ def generate_sample_holidays(year: int, seed: int = 123):
         holidays.add(date(year,m,d).isoformat())
     return sorted(holidays)
 
+# cached /holidays body, re-parsed only when the JSON file's mtime changes
+_HOL_CACHE = {"key": None, "payload": None}
+
+def holidays_payload() -> bytes:
+    try:
+        key = ("file", os.stat(HOL_JSON).st_mtime_ns)
+    except OSError:
+        # no file: the sample set depends only on the current year
+        key = ("sample", date.today().year)
+    if _HOL_CACHE["payload"] is None or _HOL_CACHE["key"] != key:
+        _HOL_CACHE["payload"] = dumps_json(load_academic_holidays())
+        _HOL_CACHE["key"] = key
+    return _HOL_CACHE["payload"]
+
 # ---------------- Auth helper ----------------
 def login_required(f):
-    from functools import wraps
     @wraps(f)
     def wrapped(*args, **kwargs):
         if session.get("user_id") is None:
@@ -206,10 +353,51 @@ def login_required(f):
         return f(*args, **kwargs)
     return wrapped
 
+# ---------------- Response cache ----------------
+def redis_cache(key_fn):
+    """Serve a GET view from Redis; key_fn gets the view kwargs and returns the key (or None to skip)."""
+    def deco(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            key = key_fn(**kwargs) if _r is not None else None
+            if key is None:
+                return f(*args, **kwargs)
+            try:
+                cached = _r.get(key)
+            except Exception:
+                cached = None
+            if cached is not None:
+                return Response(cached, mimetype="application/json")
+            resp = app.make_response(f(*args, **kwargs))
+            if resp.status_code == 200 and resp.mimetype == "application/json":
+                try:
+                    _r.setex(key, CACHE_TTL, resp.get_data(as_text=True))
+                except Exception:
+                    pass
+            return resp
+        return wrapped
+    return deco
+
+def cache_invalidate(keys):
+    if _r is None or not keys: return
+    try:
+        _r.delete(*keys)
+    except Exception:
+        pass
+
+def calendar_cache_keys(c, where: str, arg):
+    """Cache keys for every (date, route) calendar row matching where (e.g. 'route_id=?')."""
+    if _r is None: return []
+    c.execute(f"SELECT DISTINCT travel_date, route_id FROM calendar WHERE {where}", (arg,))
+    keys = []
+    for d, rid in c.fetchall():
+        keys += [f"rl:cal:{d}", f"rl:count:{d}:{rid}", f"rl:rlinks:{rid}:{d}"]
+    return keys
+
 # ---------------- Utility for messaging ----------------
 def is_member(conn, convo_id, user_id):
     c = conn.cursor()
-    c.execute("SELECT 1 FROM conversation_members WHERE conversation_id=? AND user_id=? LIMIT 1", (convo_id, user_id))
+    c.execute(SQL_IS_MEMBER, (convo_id, user_id))
     return c.fetchone() is not None
 
 # ---------------- HTTP API ----------------
@@ -225,40 +413,40 @@ def api_me():
 
 @app.route("/holidays")
 def api_holidays():
-    return jsonify(load_academic_holidays())
+    return Response(holidays_payload(), mimetype="application/json")
 
 @app.route("/next_slot")
 def api_next_slot():
     return jsonify({"slot": generate_next_slot_no()})
 
 @app.route("/calendar/<iso_date>")
+@redis_cache(lambda iso_date: f"rl:cal:{iso_date}")
 def api_calendar_for_date(iso_date):
     try:
         conn = get_db(); c = conn.cursor()
-        c.execute("""
-            SELECT DISTINCT r.id, r.slot_no, r.end_point, r.major_stops, r.time, r.transport_type
-            FROM calendar cal LEFT JOIN routes r ON cal.route_id = r.id
-            WHERE cal.travel_date = ? ORDER BY r.id DESC
-        """, (iso_date,))
+        c.execute(SQL_CALENDAR_FOR_DATE, (iso_date,))
         rows = c.fetchall()
-        out=[]
-        for r in rows:
-            out.append({k: r[k] for k in r.keys()})
-        return jsonify(out)
+        return json_response([dict(r) for r in rows])
     except Exception:
         return jsonify([]), 500
 
+def _route_count_key():
+    # normalise route_id so "01" and "1" share the key that invalidation deletes
+    iso = request.args.get("date"); rid = request.args.get("route_id", type=int)
+    return f"rl:count:{iso}:{rid}" if iso and rid is not None else None
+
 @app.route("/route_count")
+@redis_cache(_route_count_key)
 def api_route_count():
     iso = request.args.get("date"); rid = request.args.get("route_id")
     if not iso or not rid: return jsonify({"count":0})
     try:
         conn = get_db(); c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM calendar WHERE travel_date=? AND route_id=? AND link_id IS NOT NULL", (iso,rid))
+        c.execute(SQL_ROUTE_COUNT, (iso,rid))
         r = c.fetchone()
         return jsonify({"count": int(r[0]) if r else 0})
     except Exception:
-        return jsonify({"count":0})
+        return jsonify({"count":0}), 500
 
 @app.route("/routes", methods=["POST"])
 @login_required
@@ -282,7 +470,7 @@ def api_create_route():
         conn = get_db(); c = conn.cursor()
         c.execute("""
             SELECT r.id FROM routes r JOIN calendar cal ON cal.route_id = r.id
-            WHERE cal.travel_date = ? AND LOWER(r.end_point)=LOWER(?) AND COALESCE(r.time,'')=? AND LOWER(COALESCE(r.transport_type,''))=LOWER(?)
+            WHERE cal.travel_date = ? AND r.end_point = ? COLLATE NOCASE AND COALESCE(r.time,'')=? AND COALESCE(r.transport_type,'') = ? COLLATE NOCASE
             LIMIT 1
         """, (d, endp, ttime or "", ttype or ""))
         if c.fetchone(): return "Duplicate route", 409
@@ -295,27 +483,24 @@ def api_create_route():
         rid = c.lastrowid
         c.execute("INSERT INTO calendar (travel_date, route_id, link_id) VALUES (?, ?, NULL)", (d, rid))
         conn.commit()
+        cache_invalidate([f"rl:cal:{d}"])
         return jsonify({"route_id": rid}), 201
     except Exception as e:
         return str(e), 500
 
 @app.route("/routes/<int:rid>/links", methods=["GET"])
 @login_required
+@redis_cache(lambda rid: f"rl:rlinks:{rid}:{request.args['date']}" if request.args.get("date") else None)
 def api_routes_links(rid):
     # expects query param date=YYYY-MM-DD
     iso = request.args.get("date")
     if not iso: return jsonify([])
     try:
         conn = get_db(); c = conn.cursor()
-        c.execute("""
-            SELECT l.id, l.user_id, l.name, l.gender, l.drop_point, l.phone, l.course_year, l.branch
-            FROM links l JOIN calendar cal ON cal.link_id = l.id
-            WHERE cal.route_id = ? AND cal.travel_date = ?
-            ORDER BY l.id DESC
-        """, (rid, iso))
+        c.execute(SQL_ROUTE_LINKS, (rid, iso))
         rows = c.fetchall()
-        out=[{k:r[k] for k in r.keys()} for r in rows]
-        return jsonify(out)
+        out=[dict(r) for r in rows]
+        return json_response(out)
     except Exception:
         return jsonify([]), 500
 
@@ -327,7 +512,7 @@ def api_join_route(rid):
     drop = data.get("drop"); phone = data.get("phone"); year = data.get("course_year"); branch = data.get("branch")
     if not all([d, name, gender, drop, phone, year, branch]): return "Missing fields", 400
     if gender not in ("M","F"): return "Invalid gender", 400
-    if not phone.isdigit() or len(phone)<7: return "Invalid phone", 400
+    if not is_phone(phone): return "Invalid phone", 400
     try:
         sel = datetime.strptime(d, "%Y-%m-%d").date()
     except Exception:
@@ -338,12 +523,16 @@ def api_join_route(rid):
     rr = c.fetchone()
     if rr and rr["end_point"] and rr["end_point"].strip().lower() != drop.strip().lower():
         return f"Drop must match route endpoint '{rr['end_point']}'", 400
-    # duplicate check (phone)
-    c.execute("SELECT l.id FROM links l JOIN calendar cal ON cal.link_id = l.id WHERE cal.travel_date=? AND cal.route_id=? AND l.phone=?", (d, rid, phone))
-    if c.fetchone(): return "Already joined", 409
 
     current_user_id = session.get("user_id")
     try:
+        # take the write lock up front so the duplicate check and both inserts are one transaction
+        c.execute("BEGIN IMMEDIATE")
+        # duplicate check (phone)
+        c.execute("SELECT l.id FROM links l JOIN calendar cal ON cal.link_id = l.id WHERE cal.travel_date=? AND cal.route_id=? AND l.phone=?", (d, rid, phone))
+        if c.fetchone():
+            conn.rollback()
+            return "Already joined", 409
         try:
             c.execute("INSERT INTO links (user_id, name, gender, drop_point, phone, course_year, branch) VALUES (?, ?, ?, ?, ?, ?, ?)",
                       (current_user_id, name, gender, drop, phone, year, branch))
@@ -354,8 +543,11 @@ def api_join_route(rid):
         lid = c.lastrowid
         c.execute("INSERT INTO calendar (travel_date, route_id, link_id) VALUES (?, ?, ?)", (d, rid, lid))
         conn.commit()
+        # the join may also be the route's first calendar row for d
+        cache_invalidate([f"rl:cal:{d}", f"rl:count:{d}:{rid}", f"rl:rlinks:{rid}:{d}"])
         return jsonify({"link_id": lid}), 201
     except Exception as e:
+        conn.rollback()
         return str(e), 500
 
 @app.route("/links", methods=["GET"])
@@ -369,7 +561,7 @@ def api_links():
         else:
             c.execute("SELECT id, user_id, name, gender, drop_point, phone, course_year, branch FROM links ORDER BY id DESC")
         rows = c.fetchall()
-        return jsonify([{k:r[k] for k in r.keys()} for r in rows])
+        return json_response([dict(r) for r in rows])
     except Exception:
         return jsonify([])
 
@@ -379,9 +571,11 @@ def api_links_modify(lid):
     if request.method == "DELETE":
         try:
             conn = get_db(); c = conn.cursor()
+            stale = calendar_cache_keys(c, "link_id=?", lid)
             c.execute("DELETE FROM calendar WHERE link_id=?", (lid,))
             c.execute("DELETE FROM links WHERE id=?", (lid,))
             conn.commit()
+            cache_invalidate(stale)
             return jsonify({"ok": True})
         except Exception as e:
             return str(e), 500
@@ -398,6 +592,7 @@ def api_links_modify(lid):
             conn = get_db(); c = conn.cursor()
             c.execute(f"UPDATE links SET {set_sql} WHERE id=?", vals)
             conn.commit()
+            cache_invalidate(calendar_cache_keys(c, "link_id=?", lid))
             return jsonify({"ok": True})
         except Exception as e:
             return str(e), 500
@@ -408,9 +603,11 @@ def api_routes_modify(rid):
     if request.method == "DELETE":
         try:
             conn = get_db(); c = conn.cursor()
+            stale = calendar_cache_keys(c, "route_id=?", rid)
             c.execute("DELETE FROM calendar WHERE route_id=?", (rid,))
             c.execute("DELETE FROM routes WHERE id=?", (rid,))
             conn.commit()
+            cache_invalidate(stale)
             return jsonify({"ok": True})
         except Exception as e:
             return str(e), 500
@@ -425,6 +622,7 @@ def api_routes_modify(rid):
             conn = get_db(); c = conn.cursor()
             c.execute(f"UPDATE routes SET {set_sql} WHERE id=?", vals)
             conn.commit()
+            cache_invalidate(calendar_cache_keys(c, "route_id=?", rid))
             return jsonify({"ok": True})
         except Exception as e:
             return str(e), 500
@@ -439,14 +637,15 @@ def api_register():
     gender = (data.get("gender") or "").strip().upper()
     if not name or not email or not pw or gender not in ("M","F"):
         return jsonify({"error":"Missing fields"}), 400
-    if not re.match(r"^[A-Za-z0-9._%+-]+@vitstudent\.ac\.in$", email):
+    if not _VIT_EMAIL_RE.match(email):
         return jsonify({"error":"Use a VIT email"}), 400
     try:
         conn = get_db(); c = conn.cursor()
+        pw_hash = hash_pw(pw)
         try:
-            c.execute("INSERT INTO users (name, email, password_hash, gender) VALUES (?, ?, ?, ?)", (name, email, hash_pw(pw), gender))
+            c.execute("INSERT INTO users (name, email, password_hash, gender) VALUES (?, ?, ?, ?)", (name, email, pw_hash, gender))
         except Exception:
-            c.execute("INSERT INTO users (name, email, password_hash) VALUES (?, ?, ?)", (name, email, hash_pw(pw)))
+            c.execute("INSERT INTO users (name, email, password_hash) VALUES (?, ?, ?)", (name, email, pw_hash))
         conn.commit()
         return jsonify({"ok": True})
     except sqlite3.IntegrityError:
@@ -461,9 +660,15 @@ def api_login():
     pw = data.get("password") or ""
     if not email or not pw: return jsonify({"error":"Missing fields"}), 400
     conn = get_db(); c = conn.cursor()
-    c.execute("SELECT id, name FROM users WHERE email=? AND password_hash=?", (email, hash_pw(pw)))
+    c.execute("SELECT id, name, password_hash FROM users WHERE email=?", (email,))
     r = c.fetchone()
-    if r:
+    if r is None:
+        check_pw(pw, _DUMMY_PW_HASH)  # keep timing the same as a wrong password
+    elif check_pw(pw, r["password_hash"]):
+        if isinstance(r["password_hash"], str):
+            # upgrade legacy hash on successful login
+            c.execute("UPDATE users SET password_hash=? WHERE id=?", (hash_pw(pw), r["id"]))
+            conn.commit()
         session["user_id"] = r["id"]
         session["user_name"] = r["name"]
         return jsonify({"ok": True, "name": r["name"]})
@@ -484,13 +689,18 @@ def api_conversations():
         conn = get_db(); c = conn.cursor()
         c.execute("""
             SELECT conv.id, conv.title, conv.is_group, conv.route_id,
-                   (SELECT text FROM messages WHERE conversation_id=conv.id ORDER BY id DESC LIMIT 1) AS last_message,
-                   (SELECT ts FROM messages WHERE conversation_id=conv.id ORDER BY id DESC LIMIT 1) AS last_ts
+                   m.text AS last_message, m.ts AS last_ts
             FROM conversations conv
             JOIN conversation_members mem ON mem.conversation_id = conv.id
+            LEFT JOIN (
+                SELECT conversation_id, text, ts,
+                       ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY id DESC) AS rn
+                FROM messages
+                WHERE conversation_id IN (SELECT conversation_id FROM conversation_members WHERE user_id = ?)
+            ) m ON m.conversation_id = conv.id AND m.rn = 1
             WHERE mem.user_id = ?
-            ORDER BY COALESCE(last_ts, conv.created_at) DESC
-        """, (uid,))
+            ORDER BY COALESCE(m.ts, conv.created_at) DESC
+        """, (uid, uid))
         rows = c.fetchall()
         out = []
         for r in rows:
@@ -501,7 +711,7 @@ def api_conversations():
                 "route_id": r["route_id"],
                 "last_message": r["last_message"]
             })
-        return jsonify(out)
+        return json_response(out)
     except Exception as e:
         return jsonify([]), 500
 
@@ -559,19 +769,16 @@ def api_ensure_group_for_route(route_id):
             c.execute("INSERT INTO conversations (title,is_group,route_id) VALUES (?,?,?)", (title, 1, route_id))
             conv_id = c.lastrowid
             # Add all members that are linked to that route/date (distinct user_id values from links for any date in calendar for this route)
+            # plus the caller, in a single INSERT ... SELECT
             c.execute("""
-                SELECT DISTINCT l.user_id FROM calendar cal
-                JOIN links l ON l.id = cal.link_id
-                WHERE cal.route_id = ? AND l.user_id IS NOT NULL
-            """, (route_id,))
-            rows = c.fetchall()
-            member_ids = set([r[0] for r in rows if r[0]])
-            member_ids.add(uid)  # ensure caller is member
-            for mid in member_ids:
-                try:
-                    c.execute("INSERT OR IGNORE INTO conversation_members (conversation_id,user_id) VALUES (?,?)", (conv_id, mid))
-                except Exception:
-                    pass
+                INSERT OR IGNORE INTO conversation_members (conversation_id, user_id)
+                SELECT ?, user_id FROM (
+                    SELECT l.user_id FROM calendar cal
+                    JOIN links l ON l.id = cal.link_id
+                    WHERE cal.route_id = ? AND l.user_id IS NOT NULL
+                    UNION SELECT ?
+                )
+            """, (conv_id, route_id, uid))
             conn.commit()
         return jsonify({"conversation_id": conv_id})
     except Exception as e:
@@ -582,21 +789,28 @@ def api_ensure_group_for_route(route_id):
 def api_conversation_messages(conv_id):
     uid = session["user_id"]
     conn = get_db(); c = conn.cursor()
-    # check membership
-    if not is_member(conn, conv_id, uid):
-        return jsonify({"error":"Not a member"}), 403
     if request.method == "GET":
-        c.execute("SELECT m.id, m.sender_id, u.name as sender_name, m.text, m.ts FROM messages m LEFT JOIN users u ON u.id=m.sender_id WHERE m.conversation_id=? ORDER BY m.id ASC", (conv_id,))
+        # keyset paging: clients poll with the last id they have seen
+        after_id = max(request.args.get("after_id", 0, type=int), 0)
+        limit = min(max(request.args.get("limit", MESSAGES_PAGE_DEFAULT, type=int), 1), MESSAGES_PAGE_MAX)
+        # driven from the caller's membership row: no rows means not a member,
+        # a single all-NULL row means a member with no new messages
+        c.execute(SQL_MESSAGES, (after_id, conv_id, uid, limit))
         rows = c.fetchall()
-        out = [{"id":r["id"], "sender_id": r["sender_id"], "sender_name": r["sender_name"], "text": r["text"], "ts": r["ts"]} for r in rows]
-        return jsonify(out)
+        if not rows:
+            return jsonify({"error":"Not a member"}), 403
+        out = [dict(r) for r in rows if r["id"] is not None]
+        return json_response(out)
     else:
+        # check membership
+        if not is_member(conn, conv_id, uid):
+            return jsonify({"error":"Not a member"}), 403
         data = request.get_json(force=True)
         text = (data.get("text") or "").strip()
         if not text:
             return "Empty message", 400
         try:
-            c.execute("INSERT INTO messages (conversation_id, sender_id, text) VALUES (?,?,?)", (conv_id, uid, text))
+            c.execute(SQL_INSERT_MESSAGE, (conv_id, uid, session.get("user_name"), text))
             conn.commit()
             return jsonify({"ok": True}), 201
         except Exception as e: